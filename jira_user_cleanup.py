@@ -1,8 +1,32 @@
-from jira import JIRA
+from jira import JIRA, JIRAError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta, timezone
+import asyncio
+import importlib.util
+from operator import itemgetter
 import logging
 import os
-from typing import List
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# orjson decodes large user pages several times faster; fall back to the stdlib if it's missing
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# httpx is optional: with it, large batches of per-user lookups run on a single async client
+try:
+    import httpx
+    # httpx logs every request at INFO, which would drown out the report
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+except ImportError:
+    httpx = None
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
 
 # Set up logging
 logging.basicConfig(
@@ -11,97 +35,440 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upper bound on concurrent per-user lookups so we don't overload the Jira instance
+MAX_LOOKUP_WORKERS = 32
+# Writes are more heavily rate limited than reads, so deactivate with fewer workers
+MAX_DEACTIVATE_WORKERS = 8
+DEACTIVATE_ATTEMPTS = 3
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Async lookups only beat the thread pool once there are this many of them
+ASYNC_LOOKUP_THRESHOLD = 100
+ASYNC_MAX_CONNECTIONS = 100
+# HTTP/2 multiplexes many requests per connection, so in-flight requests are capped separately
+ASYNC_MAX_IN_FLIGHT = 100
+LOOKUP_ATTEMPTS = 3
+# Keep enough pooled keep-alive connections for every concurrent worker
+HTTP_POOL_SIZE = 64
+
+# Largest page size accepted by Jira's user search endpoint
+USER_PAGE_SIZE = 1000
+# Let the server drop deactivated accounts instead of sending them over the wire
+USER_SEARCH_PARAMS = {
+    'username': '.',
+    'includeActive': True,
+    'includeInactive': False,
+    'expand': 'lastLoginTime'
+}
+
+def _parse_login_datetime(value: str) -> datetime:
+    """Parse a Jira lastLoginTime value (e.g. 2024-01-31T09:15:00.000+0000), keeping its offset."""
+    # fromisoformat is implemented in C and much cheaper than strptime
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def _parse_last_login(value: str) -> float:
+    """Parse a Jira lastLoginTime value into a POSIX timestamp."""
+    # Timestamps compare as plain floats, without going through tzinfo on every comparison
+    return _parse_login_datetime(value).timestamp()
+
+class LastLoginCache:
+    """SQLite-backed cache of raw lastLoginTime values, keyed by username."""
+
+    def __init__(self, path: str, ttl_seconds: int = 3600):
+        """
+        Open (or create) the cache database
+        
+        Args:
+            path: Location of the SQLite file
+            ttl_seconds: How long a cached value is considered fresh
+        """
+        self.ttl_seconds = ttl_seconds
+        # Lookups run from worker threads, so share one connection behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS last_login ("
+                "username TEXT PRIMARY KEY, last_login TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+
+    def get(self, username: str) -> Optional[str]:
+        """Return the cached lastLoginTime for a user, or None if missing or stale."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_login, fetched_at FROM last_login WHERE username = ?", (username,)
+            ).fetchone()
+        if row and time.time() - row[1] < self.ttl_seconds:
+            return row[0]
+        return None
+
+    def set(self, username: str, last_login: str):
+        """Store a freshly fetched lastLoginTime for a user."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO last_login (username, last_login, fetched_at) VALUES (?, ?, ?)",
+                (username, last_login, time.time())
+            )
+
 class JiraUserManager:
-    def __init__(self, jira_url: str, access_token: str):
+    def __init__(self, jira_url: str, access_token: str, cache_path: Optional[str] = None,
+                 login_ordered_search: bool = False):
         """
         Initialize Jira connection using Personal Access Token
         
         Args:
             jira_url: Your Jira instance URL
             access_token: Your Jira Personal Access Token
+            cache_path: Optional SQLite file used to cache last login times between runs
+            login_ordered_search: Set if the instance's user search honours
+                orderBy=lastLoginTime (oldest first), so scans can stop at the cutoff
         """
+        self.login_ordered_search = login_ordered_search
+        self.jira_url = jira_url.rstrip('/')
+        self.access_token = access_token
+        self.login_cache = LastLoginCache(cache_path) if cache_path else None
         self.jira = JIRA(
             server=jira_url,
             token_auth=access_token  # Using PAT authentication
         )
+        # The default adapter only pools 10 connections, which makes concurrent
+        # workers wait on each other or reopen TLS connections.
+        # jira's ResilientSession already retries 429/503 (honouring Retry-After) and
+        # connection errors, so only the other gateway errors are retried here, and the
+        # final response is returned rather than raised so jira can still turn it into a
+        # JIRAError with a status code.
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(
+                total=3, connect=0, read=0, backoff_factor=0.2,
+                status_forcelist=[500, 502, 504], raise_on_status=False
+            )
+        )
+        self.jira._session.mount('https://', adapter)
+        self.jira._session.mount('http://', adapter)
         
-    def get_all_active_users(self) -> List[dict]:
-        """Get all active users from Jira."""
+    def _get_json(self, path: str, params: dict = None):
+        """GET a Jira REST resource and decode the response body."""
+        response = self.jira._session.get(self.jira._get_url(path), params=params)
+        return json_loads(response.content)
+
+    def _fetch_users_parallel(self, page_size: int = USER_PAGE_SIZE, concurrency: int = 8,
+                              login_before: Optional[datetime] = None) -> Iterator[dict]:
+        """
+        Yield all users from the user search endpoint, fetching several pages at a time.
+        
+        Args:
+            page_size: Number of users requested per page
+            concurrency: Number of pages requested in parallel
+            login_before: If given, ask for users ordered by last login and stop
+                after the first page that ends with a login at or after this date
+        """
+        params = dict(USER_SEARCH_PARAMS)
+        login_before_ts = None
+        if login_before is not None:
+            params['orderBy'] = 'lastLoginTime'
+            login_before_ts = login_before.timestamp()
+        start_at = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                # user/search doesn't report a total, so request the next
+                # `concurrency` windows together and stop at the first short page
+                futures = [
+                    pool.submit(self._get_json, 'user/search', params={
+                        **params,
+                        'startAt': start_at + i * page_size,
+                        'maxResults': page_size
+                    })
+                    for i in range(concurrency)
+                ]
+                for future in futures:
+                    page = future.result()
+                    yield from page
+                    if len(page) < page_size:
+                        return
+                    # With oldest logins first, every later page is newer than the cutoff too
+                    last_login = page[-1].get('lastLoginTime') if login_before_ts is not None else None
+                    if last_login and _parse_last_login(last_login) >= login_before_ts:
+                        return
+                start_at += concurrency * page_size
+
+    def get_all_active_users(self, login_before: Optional[datetime] = None) -> Iterator[dict]:
+        """
+        Yield all active users from Jira, with their raw last login time attached.
+        
+        Args:
+            login_before: Stop scanning once only users who logged in after this date remain.
+                Only honoured when the manager was created with login_ordered_search.
+        """
+        if not self.login_ordered_search:
+            login_before = None
         try:
-            # Get all users with 'active' status
-            users = self.jira.search_users(query='', maxResults=False)
-            active_users = [user for user in users if user.active]
-            logger.info(f"Found {len(active_users)} active users")
-            return active_users
+            # Deactivated users are already filtered out by the server (includeInactive=false).
+            # Only the fields we use are kept, the rest of the raw payload is dropped.
+            active_count = 0
+            for user in self._fetch_users_parallel(login_before=login_before):
+                active_count += 1
+                yield {
+                    'name': user['name'],
+                    'lastLoginTime': user.get('lastLoginTime')
+                }
+            logger.info("Found %d active users", active_count)
         except Exception as e:
-            logger.error(f"Error getting active users: {str(e)}")
+            logger.error("Error getting active users: %s", e)
             raise
 
-    def get_user_last_login(self, username: str) -> datetime:
-        """Get the last login date for a user."""
+    def get_user_last_login(self, user: Union[str, dict], use_cache: bool = True) -> Optional[float]:
+        """
+        Get the last login time for a user, as a POSIX timestamp.
+        
+        Args:
+            user: Username, or a user dict from get_all_active_users. A dict's
+                lastLoginTime is used as-is and Jira is only queried when it's missing.
+            use_cache: Read the last login cache before querying Jira
+        """
+        last_login = self._get_raw_last_login(user, use_cache)
+        return _parse_last_login(last_login) if last_login else None
+
+    def _get_raw_last_login(self, user: Union[str, dict], use_cache: bool = True) -> Optional[str]:
+        """Get a user's lastLoginTime as Jira returned it, see get_user_last_login."""
+        if isinstance(user, dict):
+            username = user['name']
+            last_login = user.get('lastLoginTime')
+        else:
+            username = user
+            last_login = None
         try:
-            # Note: This requires the appropriate Jira permissions
-            user = self.jira.user(username)
-            last_login = user.raw.get('lastLoginTime')
-            if last_login:
-                return datetime.strptime(last_login, "%Y-%m-%dT%H:%M:%S.%f%z")
-            return None
+            if last_login is None and use_cache and self.login_cache:
+                last_login = self.login_cache.get(username)
+            if last_login is None:
+                # Note: This requires the appropriate Jira permissions.
+                # Read the raw JSON rather than building a jira User resource around it.
+                last_login = self._get_json('user', params={'username': username}).get('lastLoginTime')
+                if last_login and self.login_cache:
+                    self.login_cache.set(username, last_login)
+            return last_login or None
         except Exception as e:
-            logger.error(f"Error getting last login for user {username}: {str(e)}")
+            logger.error("Error getting last login for user %s: %s", username, e)
             return None
 
+    async def _get_user_async(self, client, semaphore: asyncio.Semaphore, username: str):
+        """GET a single user on the async client, retrying rate limits and server errors with backoff."""
+        for attempt in range(LOOKUP_ATTEMPTS):
+            last_attempt = attempt == LOOKUP_ATTEMPTS - 1
+            try:
+                async with semaphore:
+                    response = await client.get('/rest/api/2/user', params={'username': username})
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            if response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+                # Honour Retry-After (in seconds) on throttled responses, like jira's ResilientSession
+                retry_after = response.headers.get('Retry-After', '')
+                await asyncio.sleep(float(retry_after) if retry_after.isdigit() else 0.5 * 2 ** attempt)
+                continue
+            return response
+
+    async def _fetch_all_logins(self, usernames: List[str], use_cache: bool = True) -> Dict[str, Optional[str]]:
+        """
+        Fetch raw lastLoginTime values for many users concurrently with httpx.
+        
+        Args:
+            usernames: Users to look up
+            use_cache: Use cached values where still fresh instead of querying Jira
+        """
+        last_logins = {}
+        to_fetch = []
+        for username in usernames:
+            cached = self.login_cache.get(username) if use_cache and self.login_cache else None
+            if cached:
+                last_logins[username] = cached
+            else:
+                to_fetch.append(username)
+
+        # Reuse the JIRA session's TLS, proxy and header settings. The PAT is applied by
+        # a requests auth hook there, so the bearer header is only added if it's missing.
+        session = self.jira._session
+        headers = dict(session.headers)
+        headers.setdefault('Authorization', f"Bearer {self.access_token}")
+        headers['Accept'] = 'application/json'
+        semaphore = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+        async with httpx.AsyncClient(
+            base_url=self.jira_url,
+            headers=headers,
+            verify=session.verify,
+            cert=session.cert,
+            proxy=session.proxies.get('https'),
+            trust_env=session.trust_env,
+            http2=HTTP2_AVAILABLE,  # Multiplex requests over one connection when h2 is installed
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS)
+        ) as client:
+            responses = await asyncio.gather(
+                *[self._get_user_async(client, semaphore, username) for username in to_fetch],
+                return_exceptions=True
+            )
+
+        for username, response in zip(to_fetch, responses):
+            if isinstance(response, Exception):
+                logger.error("Error getting last login for user %s: %s", username, response)
+                last_logins[username] = None
+                continue
+            if response.is_error:
+                logger.error("Error getting last login for user %s: HTTP %d", username, response.status_code)
+                last_logins[username] = None
+                continue
+            last_login = json_loads(response.content).get('lastLoginTime')
+            if last_login and self.login_cache:
+                self.login_cache.set(username, last_login)
+            last_logins[username] = last_login
+        return last_logins
+
+    def _iter_last_logins(self, users: Iterable[dict], use_cache: bool = True) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        Yield (username, raw lastLoginTime) for each user.
+        Users whose search entry lacks lastLoginTime are looked up individually, on an
+        async client for large batches when httpx is installed, otherwise in a bounded pool.
+        Those lookups skip the last login cache when use_cache is False.
+        """
+        with ThreadPoolExecutor(max_workers=MAX_LOOKUP_WORKERS) as pool:
+            futures = {}
+            # With httpx, lookups are held back until the scan ends so a large batch can go
+            # through the async client; without it they start while pages are still arriving
+            held_back = []
+            for user in users:
+                if user.get('lastLoginTime'):
+                    yield user['name'], user['lastLoginTime']
+                elif httpx is not None:
+                    held_back.append(user['name'])
+                else:
+                    futures[pool.submit(self._get_raw_last_login, user['name'], use_cache)] = user['name']
+
+            if len(held_back) >= ASYNC_LOOKUP_THRESHOLD:
+                last_logins = asyncio.run(self._fetch_all_logins(held_back, use_cache))
+                for username in held_back:
+                    yield username, last_logins.get(username)
+            else:
+                for username in held_back:
+                    futures[pool.submit(self._get_raw_last_login, username, use_cache)] = username
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
     def deactivate_user(self, username: str) -> bool:
-        """Deactivate a Jira user."""
-        try:
-            # Note: This requires admin permissions
-            self.jira.deactivate_user(username)
-            logger.info(f"Successfully deactivated user: {username}")
-            return True
-        except Exception as e:
-            logger.error(f"Error deactivating user {username}: {str(e)}")
+        """Deactivate a Jira user, retrying with exponential backoff on rate limits and server errors."""
+        for attempt in range(DEACTIVATE_ATTEMPTS):
+            try:
+                # Note: This requires admin permissions
+                result = self.jira.deactivate_user(username)
+            except JIRAError as e:
+                # jira re-raises failed requests without a status, which stays on the chained session error
+                status_code = e.status_code or getattr(e.__context__, 'status_code', None)
+                if status_code in RETRYABLE_STATUS_CODES and attempt < DEACTIVATE_ATTEMPTS - 1:
+                    time.sleep(0.5 * 2 ** attempt)
+                    continue
+                logger.error("Error deactivating user %s: %s", username, e)
+                return False
+            except Exception as e:
+                logger.error("Error deactivating user %s: %s", username, e)
+                return False
+            # On Server/DC jira returns True only for HTTP 200 and the status code for other successful responses
+            if result is True:
+                logger.info("Successfully deactivated user: %s", username)
+                return True
+            logger.error("Error deactivating user %s: HTTP %s", username, result)
             return False
 
-    def cleanup_inactive_users(self, days_threshold: int = 60):
+    def deactivate_users(self, usernames: List[str]) -> List[str]:
+        """
+        Deactivate several users concurrently.
+        
+        Args:
+            usernames: Users to deactivate
+            
+        Returns:
+            The usernames that could not be deactivated
+        """
+        with ThreadPoolExecutor(max_workers=MAX_DEACTIVATE_WORKERS) as pool:
+            results = list(pool.map(self.deactivate_user, usernames))
+        failed = [username for username, deactivated in zip(usernames, results) if not deactivated]
+        if failed:
+            logger.error("Failed to deactivate %d users: %s", len(failed), ', '.join(failed))
+        return failed
+
+    def cleanup_inactive_users(self, days_threshold: int = 60, deactivate: bool = False):
         """
         Find users who haven't logged in for the specified number of days.
-        Currently only lists users without deactivating them.
+        By default only lists users without deactivating them.
         
         Args:
             days_threshold: Number of days of inactivity before listing
+            deactivate: Also deactivate the inactive users that were found, except
+                the admin account and the account that owns the access token
         """
-        cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_threshold)
-        active_users = self.get_all_active_users()
-        
+        now = datetime.now(timezone.utc)
+        cutoff_date = now - timedelta(days=days_threshold)
+        now_ts = now.timestamp()
+        cutoff_ts = cutoff_date.timestamp()
+        active_count = 0
         inactive_users = []
-        for user in active_users:
-            last_login = self.get_user_last_login(user.name)
+        # Never deactivate anyone based on a cached (up to an hour old) last login
+        last_logins = self._iter_last_logins(
+            self.get_all_active_users(login_before=cutoff_date), use_cache=not deactivate
+        )
+        for username, raw_last_login in last_logins:
+            active_count += 1
             
-            if last_login is None:
-                logger.warning(f"Could not determine last login for user: {user.name}")
+            if raw_last_login is None:
+                logger.warning("Could not determine last login for user: %s", username)
                 continue
                 
-            if last_login < cutoff_date:
-                logger.info(f"Inactive user found - Username: {user.name}, Last login: {last_login}")
+            last_login_ts = _parse_last_login(raw_last_login)
+            if last_login_ts < cutoff_ts:
+                # Only the (few) inactive users need a datetime, for display in Jira's own offset
+                last_login = _parse_login_datetime(raw_last_login)
+                logger.info("Inactive user found - Username: %s, Last login: %s", username, last_login)
                 inactive_users.append({
-                    'username': user.name,
+                    'username': username,
                     'last_login': last_login,
-                    'days_inactive': (datetime.now(timezone.utc) - last_login).days
+                    'days_inactive': int((now_ts - last_login_ts) // 86400)
                 })
         
         # Print summary
-        logger.info(f"\nInactive Users Summary:")
-        logger.info(f"Total active users checked: {len(active_users)}")
-        logger.info(f"Total inactive users found: {len(inactive_users)}")
+        logger.info("\nInactive Users Summary:")
+        logger.info("Total active users checked: %d", active_count)
+        logger.info("Total inactive users found: %d", len(inactive_users))
+        
+        if deactivate and inactive_users:
+            # Never deactivate the admin account or the one we're authenticated as
+            protected = {'admin', self.jira.current_user()}
+            to_deactivate = []
+            for user in inactive_users:
+                if user['username'] in protected:
+                    logger.warning("Skipping admin user: %s", user['username'])
+                else:
+                    to_deactivate.append(user['username'])
+            failed = self.deactivate_users(to_deactivate)
+            logger.info("Users deactivated: %d", len(to_deactivate) - len(failed))
+            logger.info("Users skipped (admin accounts): %d", len(inactive_users) - len(to_deactivate))
         
-        if inactive_users:
-            logger.info("\nDetailed list of inactive users:")
-            for user in sorted(inactive_users, key=lambda x: x['days_inactive'], reverse=True):
-                logger.info(f"Username: {user['username']:<30} Last login: {user['last_login']} ({user['days_inactive']} days ago)")
+        # Building the detailed list means sorting and formatting every row, so skip it when INFO is off
+        if inactive_users and logger.isEnabledFor(logging.INFO):
+            # Emit the whole list as one record rather than one log call per user
+            details = "\n".join([
+                f"Username: {user['username']:<30} Last login: {user['last_login']} ({user['days_inactive']} days ago)"
+                for user in sorted(inactive_users, key=itemgetter('days_inactive'), reverse=True)
+            ])
+            logger.info("\nDetailed list of inactive users:\n%s", details)
 
 def main():
     # Get Jira credentials from environment variables
     jira_url = os.getenv('JIRA_URL')
     jira_pat = os.getenv('JIRA_PAT')  # Personal Access Token
+    login_cache = os.getenv('JIRA_LOGIN_CACHE')  # Optional SQLite file for caching last logins
+    # Only enable if the instance's user search supports orderBy=lastLoginTime
+    login_ordered_search = os.getenv('JIRA_LOGIN_ORDERED_SEARCH', '').lower() in ('1', 'true', 'yes')
+    deactivate = os.getenv('JIRA_DEACTIVATE', '').lower() in ('1', 'true', 'yes')
     
     if not all([jira_url, jira_pat]):
         logger.error("Missing required environment variables. Please set JIRA_URL and JIRA_PAT")
@@ -109,13 +476,13 @@ def main():
     
     try:
         # Initialize the Jira user manager with PAT
-        jira_manager = JiraUserManager(jira_url, jira_pat)
+        jira_manager = JiraUserManager(jira_url, jira_pat, login_cache, login_ordered_search)
         
         # Run the cleanup process
-        jira_manager.cleanup_inactive_users()
+        jira_manager.cleanup_inactive_users(deactivate=deactivate)
         
     except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
+        logger.error("An error occurred: %s", e)
 
 if __name__ == "__main__":
     main() 
@@ -0,0 +1,177 @@
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('jira')
+
+from jira import JIRAError
+
+import jira_user_cleanup
+from jira_user_cleanup import JiraUserManager, _parse_last_login
+
+
+def make_manager(monkeypatch, **kwargs):
+    """Build a JiraUserManager around a mocked JIRA client."""
+    monkeypatch.setattr(jira_user_cleanup, 'JIRA', mock.MagicMock())
+    return JiraUserManager('https://jira.example.com', 'token', **kwargs)
+
+
+def test_search_entries_without_last_login_fall_back_to_user_lookup(monkeypatch):
+    monkeypatch.setattr(jira_user_cleanup, 'httpx', None)
+    manager = make_manager(monkeypatch)
+    lookups = []
+
+    def fake_get_json(path, params=None):
+        if path == 'user/search':
+            return [
+                {'name': 'alice', 'lastLoginTime': '2024-01-31T09:15:00.000+0000'},
+                {'name': 'bob'}
+            ]
+        lookups.append(params['username'])
+        return {'name': params['username'], 'lastLoginTime': '2023-06-01T00:00:00.000+0000'}
+
+    monkeypatch.setattr(manager, '_get_json', fake_get_json)
+    last_logins = dict(manager._iter_last_logins(manager.get_all_active_users()))
+
+    assert last_logins == {
+        'alice': '2024-01-31T09:15:00.000+0000',
+        'bob': '2023-06-01T00:00:00.000+0000'
+    }
+    assert lookups == ['bob']
+
+
+def test_last_login_cache_returns_fresh_values(tmp_path):
+    cache = jira_user_cleanup.LastLoginCache(str(tmp_path / 'cache.sqlite'))
+    cache.set('alice', '2024-01-31T09:15:00.000+0000')
+
+    assert cache.get('alice') == '2024-01-31T09:15:00.000+0000'
+    assert cache.get('bob') is None
+
+
+def test_last_login_cache_overwrites_existing_values(tmp_path):
+    cache = jira_user_cleanup.LastLoginCache(str(tmp_path / 'cache.sqlite'))
+    cache.set('alice', '2024-01-31T09:15:00.000+0000')
+    cache.set('alice', '2024-02-29T10:00:00.000+0000')
+
+    assert cache.get('alice') == '2024-02-29T10:00:00.000+0000'
+
+
+def test_last_login_cache_expires_values_after_ttl(tmp_path, monkeypatch):
+    cache = jira_user_cleanup.LastLoginCache(str(tmp_path / 'cache.sqlite'), ttl_seconds=3600)
+    monkeypatch.setattr(jira_user_cleanup.time, 'time', lambda: 1_000_000.0)
+    cache.set('alice', '2024-01-31T09:15:00.000+0000')
+
+    monkeypatch.setattr(jira_user_cleanup.time, 'time', lambda: 1_000_000.0 + 3599)
+    assert cache.get('alice') == '2024-01-31T09:15:00.000+0000'
+    monkeypatch.setattr(jira_user_cleanup.time, 'time', lambda: 1_000_000.0 + 3600)
+    assert cache.get('alice') is None
+
+
+def test_get_user_last_login_can_bypass_the_cache(tmp_path, monkeypatch):
+    manager = make_manager(monkeypatch, cache_path=str(tmp_path / 'cache.sqlite'))
+    manager.login_cache.set('alice', '2020-01-01T00:00:00.000+0000')
+    monkeypatch.setattr(manager, '_get_json', lambda path, params=None: {
+        'name': 'alice', 'lastLoginTime': '2024-01-31T09:15:00.000+0000'
+    })
+
+    assert manager.get_user_last_login('alice') == _parse_last_login('2020-01-01T00:00:00.000+0000')
+    assert manager.get_user_last_login('alice', use_cache=False) == _parse_last_login('2024-01-31T09:15:00.000+0000')
+    # The fresh value is still written back for later cached reads
+    assert manager.login_cache.get('alice') == '2024-01-31T09:15:00.000+0000'
+
+
+def test_async_lookups_retry_throttled_and_server_errors(monkeypatch):
+    httpx = pytest.importorskip('httpx')
+    manager = make_manager(monkeypatch)
+    manager.jira._session = mock.Mock(headers={}, verify=True, cert=None, proxies={}, trust_env=False)
+    attempts = {}
+
+    def handler(request):
+        username = request.url.params['username']
+        attempts[username] = attempts.get(username, 0) + 1
+        if username == 'throttled' and attempts[username] == 1:
+            return httpx.Response(429, headers={'Retry-After': '0'})
+        if username == 'broken':
+            return httpx.Response(503, headers={'Retry-After': '0'})
+        return httpx.Response(200, json={'name': username, 'lastLoginTime': '2024-01-31T09:15:00.000+0000'})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, 'AsyncClient', lambda **kwargs: real_client(
+        **{**kwargs, 'http2': False}, transport=httpx.MockTransport(handler)
+    ))
+    last_logins = jira_user_cleanup.asyncio.run(manager._fetch_all_logins(['throttled', 'broken']))
+
+    assert last_logins == {'throttled': '2024-01-31T09:15:00.000+0000', 'broken': None}
+    assert attempts == {'throttled': 2, 'broken': jira_user_cleanup.LOOKUP_ATTEMPTS}
+
+
+def test_fallback_lookups_start_before_the_scan_finishes_without_httpx(monkeypatch):
+    monkeypatch.setattr(jira_user_cleanup, 'httpx', None)
+    manager = make_manager(monkeypatch)
+    looked_up = jira_user_cleanup.threading.Event()
+    monkeypatch.setattr(manager, '_get_raw_last_login', lambda user, use_cache=True: looked_up.set())
+
+    def users():
+        yield {'name': 'bob', 'lastLoginTime': None}
+        # The scan is still running here, but bob's lookup should already be under way
+        assert looked_up.wait(timeout=5)
+        yield {'name': 'carol', 'lastLoginTime': None}
+
+    assert sorted(username for username, _ in manager._iter_last_logins(users())) == ['bob', 'carol']
+
+
+def deactivate_error(status_code):
+    """Build the JIRAError jira.deactivate_user raises, chained from the session's error like jira does."""
+    try:
+        raise JIRAError('Forbidden', status_code=status_code)
+    except JIRAError as e:
+        try:
+            raise JIRAError(f"Error Deactivating alice: {e}")
+        except JIRAError as wrapped:
+            return wrapped
+
+
+@pytest.mark.parametrize('responses, attempts, deactivated', [
+    ([True], 1, True),
+    ([deactivate_error(503), True], 2, True),
+    ([deactivate_error(503), deactivate_error(503), deactivate_error(503)], 3, False),
+    ([deactivate_error(403)], 1, False),
+    ([JIRAError('Not Found', status_code=404)], 1, False),
+    ([302], 1, False)
+])
+def test_deactivate_user_retries_only_retryable_statuses(monkeypatch, responses, attempts, deactivated):
+    monkeypatch.setattr(jira_user_cleanup.time, 'sleep', lambda seconds: None)
+    manager = make_manager(monkeypatch)
+    manager.jira.deactivate_user.side_effect = responses
+
+    assert manager.deactivate_user('alice') is deactivated
+    assert manager.jira.deactivate_user.call_count == attempts
+
+
+def test_cleanup_never_deactivates_admin_or_the_token_owner(monkeypatch):
+    manager = make_manager(monkeypatch)
+    manager.jira.current_user.return_value = 'svc-cleanup'
+    long_ago = '2020-01-01T00:00:00.000+0000'
+    monkeypatch.setattr(manager, 'get_all_active_users', lambda login_before=None: iter(()))
+    monkeypatch.setattr(manager, '_iter_last_logins', lambda users, use_cache=True: iter([
+        ('admin', long_ago), ('svc-cleanup', long_ago), ('alice', long_ago)
+    ]))
+    deactivate_users = mock.Mock(return_value=[])
+    monkeypatch.setattr(manager, 'deactivate_users', deactivate_users)
+
+    manager.cleanup_inactive_users(deactivate=True)
+
+    deactivate_users.assert_called_once_with(['alice'])
+
+
+def test_report_keeps_jiras_last_login_offset(monkeypatch, caplog):
+    manager = make_manager(monkeypatch)
+    monkeypatch.setattr(manager, 'get_all_active_users', lambda login_before=None: iter(()))
+    monkeypatch.setattr(manager, '_iter_last_logins', lambda users, use_cache=True: iter([
+        ('alice', '2020-01-01T09:00:00.000+0200')
+    ]))
+
+    with caplog.at_level('INFO', logger=jira_user_cleanup.logger.name):
+        manager.cleanup_inactive_users()
+
+    assert 'Last login: 2020-01-01 09:00:00+02:00' in caplog.text